@@ -256,12 +256,12 @@ class Molecule(object):
         :type file_name: str
 
         """
+        lines = ["{:3d}\n".format(self.number_of_atoms),
+                 "{}: {}\n".format(self.title, self.energy)]
+        lines.extend("%-2s%12.5f%12.5f%12.5f\n" % (element_symbol, x, y, z)
+                     for element_symbol, (x, y, z) in zip(self.atoms_list, self.coordinates))
         with open(file_name, 'w') as fp:
-            fp.write("{:3d}\n".format(self.number_of_atoms))
-            fp.write("{}: {}\n".format(self.title, self.energy))
-            for element_symbol, atom_coordinate in zip(self.atoms_list, self.coordinates):
-                fp.write("%-2s%12.5f%12.5f%12.5f\n" % (
-                    element_symbol, atom_coordinate[0], atom_coordinate[1], atom_coordinate[2]))
+            fp.write(''.join(lines))
 
     def mol_to_turbomole_coord(self):
         """
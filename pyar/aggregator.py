@@ -1,10 +1,18 @@
-import copy
+import hashlib
 import logging
 import os
+import pickle
 import random
 import shutil
 import string
-from collections import OrderedDict
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import islice, permutations, repeat
+from math import factorial
+
+import numpy as np
+from scipy.spatial.distance import pdist
 
 from pyar import tabu, file_manager
 from pyar.data_analysis import clustering
@@ -12,12 +20,228 @@ from pyar.optimiser import optimise
 
 aggregator_logger = logging.getLogger('pyar.aggregator')
 
+OPTIMISATION_CACHE_SIZE = 4096
+_optimisation_cache = OrderedDict()
+
+PATHWAY_SEED = 0
+
+
+def _number_of_orderings(counts):
+    """Number of distinct orderings of a multiset, given as a Counter."""
+    orderings = factorial(sum(counts.values()))
+    for count in counts.values():
+        orderings //= factorial(count)
+    return orderings
+
+
+def _first_two_swapped(pathway, interchangeable):
+    """Is pathway a repeat of the one with its first two monomers swapped?"""
+    return (len(pathway) >= 2 and pathway[0] > pathway[1]
+            and pathway[0] in interchangeable and pathway[1] in interchangeable)
+
+
+def _number_of_distinct_pathways(monomer_names, interchangeable):
+    """Number of pathways that distinct_pathways can give."""
+    counts = Counter(monomer_names)
+    total = _number_of_orderings(counts)
+    if len(monomer_names) < 2:
+        return total
+    for first, second in permutations(counts, 2):
+        if _first_two_swapped((first, second), interchangeable):
+            rest = counts.copy()
+            rest[first] -= 1
+            rest[second] -= 1
+            total -= _number_of_orderings(rest)
+    return total
+
+
+def distinct_pathways(monomer_names, interchangeable=frozenset(), seed=PATHWAY_SEED):
+    """
+    Orders in which the monomers can be added to build the aggregate.
+
+    Distinct orderings are drawn at random from the whole space of
+    pathways, so that a few pathways still cover different ways of
+    growing the aggregate. The random number generator is seeded, so
+    the n-th pathway is the same in every run and a broken job can be
+    restarted from first_pathway. Nothing is enumerated up front; the
+    generator stops when every distinct pathway has been given.
+
+    The first two monomers only form a dimer. When both are in
+    interchangeable, 'a' + 'b' searches the same dimers as 'b' + 'a', so
+    only the pathway with the first two names in sorted order is kept.
+    Trial geometries are made differently for a single-atom monomer
+    (see tabu.create_trial_geometries), so atoms should not be listed
+    as interchangeable.
+    """
+    rng = random.Random(seed)
+    pool = list(monomer_names)
+    number_of_pathways = _number_of_distinct_pathways(pool, interchangeable)
+    seen = set()
+    while len(seen) < number_of_pathways:
+        rng.shuffle(pool)
+        pathway = tuple(pool)
+        if _first_two_swapped(pathway, interchangeable):
+            continue
+        if pathway not in seen:
+            seen.add(pathway)
+            yield pathway
+
+
+def orientation_schedule(hm_orientations, number_of_steps):
+    """
+    Number of trial orientations for each aggregation step.
+
+    With 'auto', the search starts with 8 orientations and doubles after
+    every step until it has gone past 256; otherwise hm_orientations is
+    used at every step.
+
+    :return: list with one entry per step
+    """
+    if hm_orientations != 'auto':
+        return [int(hm_orientations)] * number_of_steps
+    schedule = []
+    number_of_orientations = 8
+    for _ in range(number_of_steps):
+        schedule.append(number_of_orientations)
+        if number_of_orientations <= 256:
+            number_of_orientations *= 2
+    return schedule
+
+
+def _number_of_workers(qc_params):
+    """Number of concurrent optimisations that fit on this machine."""
+    cores_per_job = qc_params.get('nprocs') or 1
+    return max(1, (os.cpu_count() or 1) // cores_per_job)
+
+
+def _run_optimise(molecule, qc_params, workdir):
+    """
+    Optimise one molecule inside workdir.
+
+    Module level so that it can be pickled and run in a worker process.
+    The optimised molecule is returned as the worker only changes its own
+    copy.
+
+    Only some interfaces pass nprocs on to the QC program; xtb, mopac
+    and turbomole would otherwise start a thread per core in every
+    worker. The worker's thread count is therefore limited to nprocs,
+    which the programs it launches inherit.
 
-def random_permutation(iterable, r=None):
-    """Random selection from itertools.permutations(iterable, r)"""
-    pool = tuple(iterable)
-    r = len(pool) if r is None else r
-    return tuple(random.sample(pool, r))
+    :return: (status, optimised molecule)
+    """
+    threads = str(qc_params.get('nprocs') or 1)
+    os.environ['OMP_NUM_THREADS'] = threads
+    os.environ['MKL_NUM_THREADS'] = threads
+    os.chdir(workdir)
+    status = optimise(molecule, qc_params)
+    return status, molecule
+
+
+def _fingerprint(molecule):
+    """Sorted interatomic distances; equal for duplicate geometries."""
+    return np.round(np.sort(pdist(molecule.coordinates)), 3).tobytes()
+
+
+def remove_duplicate_orientations(orientations):
+    """Drop trial geometries identical to an earlier one in the list."""
+    seen = set()
+    unique = []
+    for orientation in orientations:
+        fingerprint = _fingerprint(orientation)
+        if fingerprint not in seen:
+            seen.add(fingerprint)
+            unique.append(orientation)
+    return unique
+
+
+def _optimisation_key(molecule, qc_params):
+    """Hash of the starting geometry and the calculation parameters."""
+    key = hashlib.blake2b(digest_size=16)
+    key.update(' '.join(molecule.atoms_list).encode())
+    key.update(f'{molecule.charge} {molecule.multiplicity}'.encode())
+    key.update(np.ascontiguousarray(np.round(molecule.coordinates, 4)).tobytes())
+    key.update(repr(sorted(qc_params.items())).encode())
+    return key.digest()
+
+
+def _optimise_block(molecules, qc_params, workdir):
+    """
+    Optimise the molecules in parallel, reusing earlier results.
+
+    Geometries already optimised with the same qc_params are taken from
+    a LRU cache of OPTIMISATION_CACHE_SIZE entries instead of running
+    the calculation again.
+
+    :return: list of statuses and list of the optimised molecules
+    """
+    keys = [_optimisation_key(m, qc_params) for m in molecules]
+    status_list = [None] * len(molecules)
+    to_run = []
+    for n, (key, molecule) in enumerate(zip(keys, molecules)):
+        if key in _optimisation_cache:
+            _optimisation_cache.move_to_end(key)
+            status, energy, coordinates = _optimisation_cache[key]
+            molecule.energy = energy
+            molecule.coordinates = coordinates.copy()
+            status_list[n] = status
+        else:
+            to_run.append(n)
+
+    if to_run:
+        with ProcessPoolExecutor(max_workers=_number_of_workers(qc_params)) as executor:
+            results = executor.map(_run_optimise, [molecules[n] for n in to_run],
+                                   repeat(qc_params), repeat(workdir))
+            for n, (status, molecule) in zip(to_run, results):
+                molecules[n] = molecule
+                status_list[n] = status
+                if status is True or status == 'CycleExceeded':
+                    _optimisation_cache[keys[n]] = (status, molecule.energy,
+                                                    molecule.coordinates.copy())
+        while len(_optimisation_cache) > OPTIMISATION_CACHE_SIZE:
+            _optimisation_cache.popitem(last=False)
+
+    return status_list, molecules
+
+
+def _pathway_cache_file(molecules, aggregate_sizes, number_of_orientations, qc_params,
+                        maximum_number_of_seeds, tabu_on, grid_on, site):
+    """
+    Pickle file for the seeds of finished pathway steps.
+
+    The file lives in the directory given by the PYAR_CACHE_DIR environment
+    variable and its name carries a hash of the run parameters, so a run
+    with different parameters never reads it.
+
+    :return: absolute path of the cache file, or None if caching is off
+    """
+    cache_dir = os.environ.get('PYAR_CACHE_DIR')
+    if not cache_dir:
+        return None
+    parameters = hashlib.blake2b(digest_size=8)
+    for molecule in molecules:
+        parameters.update(' '.join(molecule.atoms_list).encode())
+        parameters.update(np.ascontiguousarray(molecule.coordinates).tobytes())
+    parameters.update(repr((aggregate_sizes, number_of_orientations, sorted(qc_params.items()),
+                            maximum_number_of_seeds, tabu_on, grid_on, site)).encode())
+    os.makedirs(cache_dir, exist_ok=True)
+    return os.path.join(os.path.abspath(cache_dir), f'pathways_{parameters.hexdigest()}.pkl')
+
+
+def _load_pathway_cache(cache_file):
+    if cache_file is None or not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'rb') as fp:
+        pathway_cache = pickle.load(fp)
+    aggregator_logger.info("  Read %d finished steps from %s", len(pathway_cache), cache_file)
+    return pathway_cache
+
+
+def _save_pathway_cache(cache_file, pathway_cache):
+    if cache_file is None:
+        return
+    with open(cache_file + '.tmp', 'wb') as fp:
+        pickle.dump(pathway_cache, fp)
+    os.replace(cache_file + '.tmp', cache_file)
 
 
 def aggregate(molecules,
@@ -42,6 +266,11 @@ def aggregate(molecules,
         parameter determines how many pathways to explore.
     :type first_pathway: int
     :param first_pathway: The starting pathway. This helps in restarting the broken job.
+        Pathways are distinct orderings of the monomers drawn in a fixed
+        pseudo-random order (seeded with PATHWAY_SEED), so the same
+        first_pathway gives the same pathways in every run. When the first
+        two monomers are both molecules (not atoms), only one order of
+        the pair is used.
     :param molecules: molecules or atoms for aggregation or cluster formation.
     :type molecules: list(Molecules)
     :param aggregate_sizes: the number of each atoms in the final cluster.
@@ -60,87 +289,84 @@ def aggregate(molecules,
         aggregator_logger.info("Function: aggregate")
         return StopIteration
 
-    if hm_orientations == 'auto':
-        number_of_orientations = 8
-    else:
-        number_of_orientations = int(hm_orientations)
+    number_of_orientations = orientation_schedule(hm_orientations, 1)[0]
+
+    cache_file = _pathway_cache_file(molecules, aggregate_sizes, number_of_orientations,
+                                     qc_params, maximum_number_of_seeds,
+                                     tabu_on, grid_on, site)
+    pathway_cache = _load_pathway_cache(cache_file)
 
     parent_folder = 'aggregates'
     file_manager.make_directories(parent_folder)
     os.chdir(parent_folder)
     starting_directory = os.getcwd()
 
-    aggregator_logger.info(f"Starting Aggregation in\n {starting_directory}")
+    aggregator_logger.info("Starting Aggregation in\n %s", starting_directory)
 
     seed_names = string.ascii_lowercase
     ag_id = "ag"
 
+    name_to_monomer = {}
     monomers_to_be_added = []
     for seed_molecule, seed_name, size_of_this_seed in zip(molecules, seed_names, aggregate_sizes):
         seed_molecule.name = seed_name
-        for _ in range(size_of_this_seed):
-            monomers_to_be_added.append(seed_molecule)
+        name_to_monomer[seed_name] = seed_molecule
+        monomers_to_be_added.extend([seed_name] * size_of_this_seed)
         ag_id += f"_{seed_name}_000"
 
     if len(molecules) == 1:
-        complete_pathways = [monomers_to_be_added]
+        pathways_to_calculate = [monomers_to_be_added]
     else:
-        complete_pathways = set()
-        for _ in range(number_of_pathways):
-            new_permutation = random_permutation(monomers_to_be_added)
-            if new_permutation not in complete_pathways:
-                complete_pathways.add(new_permutation)
-
-    pathways_to_calculate = complete_pathways
-
-    aggregator_logger.info("  The following Afbau paths will be carried out")
-    for i, path in enumerate(pathways_to_calculate):
-        paths_for_print = f'   {i:03d}: '
-        for p in path:
-            paths_for_print += p.name
-        aggregator_logger.info(paths_for_print)
+        interchangeable = {name for name, monomer in name_to_monomer.items()
+                           if monomer.number_of_atoms > 1}
+        pathways_to_calculate = islice(distinct_pathways(monomers_to_be_added,
+                                                         interchangeable),
+                                       first_pathway,
+                                       first_pathway + number_of_pathways)
 
     seed_storage = OrderedDict()
-
-    initial_storage = copy.deepcopy(seed_storage)
     initial_aggregate_id = ag_id
 
-    outside_counter = first_pathway
-    inside_counter = 1
-
-    for i in pathways_to_calculate:
-        for this_monomer in i:
+    for outside_counter, i in enumerate(pathways_to_calculate, start=first_pathway):
+        aggregator_logger.info("  Afbau path %03d: %s", outside_counter, ''.join(i))
+        pathway_so_far = ()
+        for monomer_name in i:
+            this_monomer = name_to_monomer[monomer_name]
+            pathway_so_far += (monomer_name,)
             if len(seed_storage) < 1:
-                ag_id = update_id(ag_id, this_monomer.name)
+                ag_id = update_id(ag_id, monomer_name)
                 seed_storage[ag_id] = [this_monomer]
                 continue
             this_seed = seed_storage[ag_id]
-            ag_id = update_id(ag_id, this_monomer.name)
-            ag_home = "{}_{:03d}".format(ag_id, outside_counter)
-            file_manager.make_directories(ag_home)
-            os.chdir(ag_home)
-
-            seed_storage[ag_id] = add_one(ag_id,
-                                          this_seed,
-                                          this_monomer,
-                                          number_of_orientations,
-                                          qc_params,
-                                          maximum_number_of_seeds,
-                                          tabu_on, grid_on, site)
-            os.chdir(starting_directory)
+            ag_id = update_id(ag_id, monomer_name)
+            if pathway_so_far in pathway_cache:
+                aggregator_logger.info("  %s was done before, reusing its seeds for %s",
+                                       ''.join(pathway_so_far), ag_id)
+                seed_storage[ag_id] = pathway_cache[pathway_so_far]
+            else:
+                ag_home = "{}_{:03d}".format(ag_id, outside_counter)
+                file_manager.make_directories(ag_home)
+                os.chdir(ag_home)
+
+                seed_storage[ag_id] = add_one(ag_id,
+                                              this_seed,
+                                              this_monomer,
+                                              number_of_orientations,
+                                              qc_params,
+                                              maximum_number_of_seeds,
+                                              tabu_on, grid_on, site)
+                os.chdir(starting_directory)
+                if isinstance(seed_storage[ag_id], list):
+                    pathway_cache[pathway_so_far] = seed_storage[ag_id]
+                    _save_pathway_cache(cache_file, pathway_cache)
             if len(seed_storage[ag_id]) == 0:
-                aggregator_logger.info(f"No molecules were found from {ag_id}"
-                                       f"to continue this pathway.")
-                aggregator_logger.info(f"Breaking! \N{worried face}")
+                aggregator_logger.info("No molecules were found from %s"
+                                       " to continue this pathway.", ag_id)
+                aggregator_logger.info("Breaking! \N{worried face}")
                 break
             seed_storage.popitem(last=False)
-            inside_counter += 1
-        outside_counter += 1
-        seed_storage = copy.copy(initial_storage)
+        seed_storage = OrderedDict()
         ag_id = initial_aggregate_id
-
-    if hm_orientations == 'auto' and number_of_orientations <= 256:
-        number_of_orientations += 8
     return
 
 
@@ -164,14 +390,11 @@ def solvate(seeds, monomer, aggregate_size, hm_orientations,
         aggregator_logger.info("Function: solvate")
         return StopIteration
 
-    if hm_orientations == 'auto':
-        number_of_orientations = 8
-    else:
-        number_of_orientations = int(hm_orientations)
+    schedule = orientation_schedule(hm_orientations, aggregate_size)
 
     starting_directory = os.getcwd()
-    aggregator_logger.info("Starting Aggregation in\n {}".format(starting_directory))
-    for aggregation_counter in range(2, aggregate_size + 2):
+    aggregator_logger.info("Starting Aggregation in\n %s", starting_directory)
+    for aggregation_counter, number_of_orientations in enumerate(schedule, start=2):
         if len(seeds) == 0:
             aggregator_logger.info("No seeds to process")
             return
@@ -180,15 +403,13 @@ def solvate(seeds, monomer, aggregate_size, hm_orientations,
         file_manager.make_directories(aggregate_home)
         os.chdir(aggregate_home)
 
-        aggregator_logger.info(" Starting aggregation cycle: {}".format(aggregation_counter))
+        aggregator_logger.info(" Starting aggregation cycle: %d", aggregation_counter)
 
         seeds = add_one(aggregate_id, seeds, monomer, number_of_orientations,
                         qc_params, maximum_number_of_seeds, tabu_on, grid_on, site)
 
-        aggregator_logger.info(" Aggregation cycle: {} completed\n".format(aggregation_counter))
+        aggregator_logger.info(" Aggregation cycle: %d completed\n", aggregation_counter)
 
-        if hm_orientations == 'auto' and number_of_orientations <= 256:
-            number_of_orientations *= 2
         os.chdir(starting_directory)
     return
 
@@ -220,7 +441,7 @@ def add_one(aggregate_id, seeds, monomer, hm_orientations, qc_params,
     if check_stop_signal():
         aggregator_logger.info("Function: add_one")
         return StopIteration
-    aggregator_logger.info(f'  There are {len(seeds)} seed molecules in {aggregate_id}')
+    aggregator_logger.info('  There are %d seed molecules in %s', len(seeds), aggregate_id)
     cwd = os.getcwd()
 
     list_of_optimized_molecules = []
@@ -228,97 +449,97 @@ def add_one(aggregate_id, seeds, monomer, hm_orientations, qc_params,
         if check_stop_signal():
             aggregator_logger.info("Function: add_one")
             return
-        aggregator_logger.info('   Seed: {}'.format(seed_count))
+        aggregator_logger.info('   Seed: %d', seed_count)
         seed_id = "{:03d}".format(seed_count)
-        seeds_home = 'seed_' + seed_id
-        file_manager.make_directories(seeds_home)
-        os.chdir(seeds_home)
-        each_seed.mol_to_xyz('seed.xyz')
-        monomer.mol_to_xyz('monomer.xyz')
+        seed_dir = os.path.join(cwd, 'seed_' + seed_id)
+        file_manager.make_directories(seed_dir)
+        each_seed.mol_to_xyz(os.path.join(seed_dir, 'seed.xyz'))
+        monomer.mol_to_xyz(os.path.join(seed_dir, 'monomer.xyz'))
         mol_id = '{0}_{1}'.format(seed_id, aggregate_id)
         aggregator_logger.debug('Making orientations')
         all_orientations = tabu.create_trial_geometries(mol_id, seeds[seed_count],
                                                         monomer, hm_orientations,
-                                                        tabu_on, grid_on, site)
+                                                        tabu_on, grid_on, site,
+                                                        workdir=seed_dir)
         aggregator_logger.debug('Orientations are made.')
 
-        not_converged = all_orientations[:]
+        not_converged = remove_duplicate_orientations(all_orientations)
+        if len(not_converged) < len(all_orientations):
+            aggregator_logger.info("    Removed %d duplicate orientations",
+                                   len(all_orientations) - len(not_converged))
         for i in range(10):
-            if len(not_converged) > 0:
-                aggregator_logger.info(
-                    f"    Round {i + 1:d} of block optimizations with"
-                    f" {len(not_converged):d} molecules")
-                qc_params["opt_threshold"] = 'loose'
-                status_list = [optimise(each_mol, qc_params) for each_mol in
-                               not_converged]
-                converged = [n for n, s in zip(not_converged, status_list) if s is True]
-                list_of_optimized_molecules.extend(converged)
-                not_converged = [n for n, s in zip(not_converged, status_list)
-                                 if s == 'CycleExceeded' and not tabu.broken(n)]
-                not_converged = clustering.remove_similar(not_converged)
-            else:
+            if not not_converged:
                 aggregator_logger.info("    All molecules are processed")
                 break
+            aggregator_logger.info("    Round %d of block optimizations with %d molecules",
+                                   i + 1, len(not_converged))
+            qc_params["opt_threshold"] = 'loose'
+            status_list, optimised = _optimise_block(not_converged, qc_params, seed_dir)
+            cycle_exceeded = []
+            for n, s in zip(optimised, status_list):
+                if s is True:
+                    list_of_optimized_molecules.append(n)
+                elif s == 'CycleExceeded' and not tabu.broken(n):
+                    cycle_exceeded.append(n)
+            not_converged = clustering.remove_similar(cycle_exceeded)
         else:
-            aggregator_logger.info("    The following molecules are not converged"
-                                   "after 10 rounds")
-            for n, s in zip(not_converged, status_list):
-                if s == 'CycleExceeded' and not tabu.broken(n):
-                    aggregator_logger.info("      ", n.name)
-        os.chdir(cwd)
+            if aggregator_logger.isEnabledFor(logging.INFO):
+                aggregator_logger.info("    The following molecules are not converged"
+                                       " after 10 rounds")
+                for n in not_converged:
+                    aggregator_logger.info("      %s", n.name)
 
     if len(list_of_optimized_molecules) < 2:
         return list_of_optimized_molecules
     aggregator_logger.info("  Clustering")
     selected_seeds = clustering.choose_geometries(list_of_optimized_molecules,
                                                   maximum_number_of_seeds=maximum_number_of_seeds)
-    file_manager.make_directories('selected')
-    os.chdir('selected')
+    selected_dir = os.path.join(cwd, 'selected')
+    file_manager.make_directories(selected_dir)
     qc_params["opt_threshold"] = 'normal'
     aggregator_logger.info("  Optimizing the selected molecules with higher threshold")
+    refined = []
     less_than_ideal = []
-    for each_file in selected_seeds:
-        not_refined = copy.deepcopy(each_file)
-        status = optimise(each_file, qc_params)
-        if status is True:
-            # xyz_file = 'seed_' + each_file.name[4:7] + '/job_' + each_file.name + '/result_' + each_file.name + '.xyz'
-            xyz_file = 'job_' + each_file.name + '/result_' + each_file.name + '.xyz'
-            shutil.copy(xyz_file, '.')
-        else:
-            selected_seeds.remove(each_file)
-            less_than_ideal.append(not_refined)
-    if len(selected_seeds) == 0:
+    number_of_workers = min(len(selected_seeds), _number_of_workers(qc_params))
+    with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+        results = executor.map(_run_optimise, selected_seeds,
+                               repeat(qc_params), repeat(selected_dir))
+        # The workers optimise copies, so selected_seeds keeps the
+        # loosely optimised geometries to fall back on.
+        for not_refined, (status, each_file) in zip(selected_seeds, results):
+            if status is True:
+                xyz_file = os.path.join(selected_dir, 'job_' + each_file.name,
+                                        'result_' + each_file.name + '.xyz')
+                shutil.copy(xyz_file, selected_dir)
+                refined.append(each_file)
+            else:
+                less_than_ideal.append(not_refined)
+    if len(refined) == 0:
         aggregator_logger.info("    The optimization could not be refined, \n"
                                "    so sending the loosely optimised molecules")
         return less_than_ideal
     else:
-        return selected_seeds
+        return refined
 
 
+@lru_cache(maxsize=1 << 16)
 def update_id(aid, the_monomer):
     """
         aggregate_id = "a_{:03d}_b_{:03d}_c_{:03d}".format(a_n, b_n, c_n)
 
     """
-    from collections import deque
-    parts_of_aid = deque(aid.split('_'))
-    prefix = parts_of_aid.popleft()
-    d = {}
-    new_id = prefix
-    while parts_of_aid:
-        cid = parts_of_aid.popleft()
-        n = parts_of_aid.popleft()
-        d[cid] = int(n)
-        if cid == the_monomer:
-            d[cid] += 1
-        new_id += f"_{cid}_{d[cid]:03d}"
-
-    return new_id
+    parts_of_aid = aid.split('_')
+    new_id = [parts_of_aid[0]]
+    for cid, n in zip(parts_of_aid[1::2], parts_of_aid[2::2]):
+        count = int(n) + 1 if cid == the_monomer else int(n)
+        new_id.append(f"_{cid}_{count:03d}")
+
+    return ''.join(new_id)
 
 
 def check_stop_signal():
     if os.path.exists('stop') or os.path.exists('STOP'):
-        aggregator_logger.info("Found stop file, in {}".format(os.getcwd()))
+        aggregator_logger.info("Found stop file, in %s", os.getcwd())
         return 1
 
 
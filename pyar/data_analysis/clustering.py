@@ -4,6 +4,7 @@ import operator
 
 import numpy as np
 import pandas as pd
+from scipy.spatial.distance import pdist, squareform
 from sklearn.cluster import DBSCAN, AffinityPropagation, KMeans, \
     MiniBatchKMeans, MeanShift, estimate_bandwidth
 from sklearn.metrics import silhouette_score
@@ -16,60 +17,32 @@ cluster_logger = logging.getLogger('pyar.cluster')
 
 
 def remove_similar(list_of_molecules):
-    final_list = list_of_molecules[:]
-    cluster_logger.debug('Number of molecules before similarity elimination,  {}'.format(len(final_list)))
-    for a, b in itertools.combinations(list_of_molecules, 2):
-        energy_difference = calc_energy_difference(a, b)
-        fingerprint_distance = calc_fingerprint_distance(a, b)
-        if abs(energy_difference) < 1e-5 and abs(fingerprint_distance) < 1.0:
-            if energy_difference < 0:
-                if a in final_list:
-                    cluster_logger.debug('Removing {}'.format(a.name))
-                    final_list.remove(a)
-            else:
-                if b in final_list:
-                    cluster_logger.debug('Removing {}'.format(b.name))
-                    final_list.remove(b)
+    cluster_logger.debug('Number of molecules before similarity elimination,  {}'.format(len(list_of_molecules)))
+    if len(list_of_molecules) < 2:
+        return list_of_molecules[:]
+    # Energies and fingerprints are computed once per molecule and all the
+    # pairwise differences in one go, instead of once per pair.
+    energies = np.array([m.energy for m in list_of_molecules], dtype=float)
+    # The Coulomb matrix is symmetric, so its eigenvalues are real.
+    fingerprints = np.real([pyar.representations.fingerprint(m.atoms_list, m.coordinates)
+                            for m in list_of_molecules])
+    energy_differences = energies[:, np.newaxis] - energies[np.newaxis, :]
+    fingerprint_distances = squareform(pdist(fingerprints))
+    similar = (np.abs(energy_differences) < 1e-5) & (fingerprint_distances < 1.0)
+
+    removed = np.zeros(len(list_of_molecules), dtype=bool)
+    for i, j in itertools.combinations(range(len(list_of_molecules)), 2):
+        if similar[i, j]:
+            to_remove = i if energy_differences[i, j] < 0 else j
+            if not removed[to_remove]:
+                cluster_logger.debug('Removing {}'.format(list_of_molecules[to_remove].name))
+                removed[to_remove] = True
+    final_list = [m for m, r in zip(list_of_molecules, removed) if not r]
     cluster_logger.debug('Number of molecules after similarity elimination,  {}'.format(len(final_list)))
     print_energy_table(final_list)
     return final_list
 
 
-def memoize(f):
-    """ Memoization decorator for functions taking one or more arguments.
-    https://code.activestate.com/recipes/578231-probably-the-fastest-memoization-decorator-in-the-/
-    """
-
-    class MemoDict(dict):
-        # noinspection PyCompatibility
-        def __init__(self, fun):
-            super().__init__()
-            self.f = fun
-
-        def __call__(self, *args):
-            return self[args]
-
-        def __missing__(self, key):
-            ret = self[key] = self.f(*key)
-            return ret
-
-    return MemoDict(f)
-
-
-@memoize
-def calc_energy_difference(a, b):
-    return a.energy - b.energy
-
-
-@memoize
-def calc_fingerprint_distance(a, b):
-    """Calculate the distance between two fingerprints"""
-    return np.linalg.norm(
-        pyar.representations.fingerprint(a.atoms_list, a.coordinates)
-        - pyar.representations.fingerprint(b.atoms_list, b.coordinates)
-    )
-
-
 def choose_geometries(list_of_molecules, features='fingerprint', maximum_number_of_seeds=8):
     if len(list_of_molecules) < 2:
         cluster_logger.info("    Not enough data to cluster (only %d), returning original" % len(list_of_molecules))
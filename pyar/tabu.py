@@ -7,6 +7,7 @@ import collections
 import copy
 import itertools
 import logging
+import os
 
 import numpy as np
 from numpy import pi, cos, sin
@@ -315,7 +316,7 @@ def generate_points(number_of_orientations, tabu_on, grid_on, check_angle, d_thr
 
 def create_trial_geometries(molecule_id, seed, monomer,
                             number_of_orientations,
-                            tabu_on, grid_on, site):
+                            tabu_on, grid_on, site, workdir='.'):
     """
 
     :param grid_on: Use grid for making points
@@ -332,6 +333,8 @@ def create_trial_geometries(molecule_id, seed, monomer,
     :type number_of_orientations: int
     :param site:
     :type site: list[int, int] or None
+    :param workdir: Directory where tabu.dat and the trial .xyz files are written
+    :type workdir: str
     :return: A list of trial geometries
     :rtype: list
     """
@@ -346,7 +349,7 @@ def create_trial_geometries(molecule_id, seed, monomer,
     points_and_angles = generate_points(number_of_orientations, tabu_on,
                                         grid_on, tabu_check_for_angles)
     tabu_logger.debug('Generated points')
-    write_tabu_list(points_and_angles, 'tabu.dat')
+    write_tabu_list(points_and_angles, os.path.join(workdir, 'tabu.dat'))
     # plot_points(pts)
 
     tabu_logger.debug('generate orientations from points and angles')
@@ -359,7 +362,7 @@ def create_trial_geometries(molecule_id, seed, monomer,
         new_orientation.title = f'trial orientation {new_orientation_id}'
         new_orientation.name = new_orientation_id
         new_orientation_xyz_file = f'{filename_prefix}{new_orientation_id}.xyz'
-        new_orientation.mol_to_xyz(new_orientation_xyz_file)
+        new_orientation.mol_to_xyz(os.path.join(workdir, new_orientation_xyz_file))
         orientations.append(new_orientation)
 
     return orientations